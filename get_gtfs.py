@@ -3,55 +3,239 @@ Updates the static GTFS data, which updates every week.
 
 '''
 import requests
+import hashlib
+import json
 import os.path
+import sys
+import time
+from contextlib import contextmanager
 from zipfile import ZipFile
-from functools import reduce
-import shutil
+import numpy as np
 import pandas as pd
-import pickle
 
-# Get if it doesn't exist
+from src.bundle import BUNDLE_FORMAT, read_manifest, write_bundle
+from src.geometry import significance, to_xy
 
-with open('gtfs.zip', 'wb') as file:
-    file.write(
-        requests.get(
-            'http://data.ptv.vic.gov.au/downloads/gtfs.zip', stream=True).content)
+GTFS_URL = 'http://data.ptv.vic.gov.au/downloads/gtfs.zip'
+GTFS_ZIP = 'gtfs.zip'
+# Downloads in progress go here first, so an interrupted one can be resumed and gtfs.zip is always whole
+GTFS_PART = GTFS_ZIP + '.part'
+# ETag and Last-Modified of the file next to them, for conditional and resumed requests
+GTFS_META = GTFS_ZIP + '.json'
+GTFS_PART_META = GTFS_PART + '.json'
+CHUNK_SIZE = 1 << 20
+# Only the Metro VIC data
+METRO_ZIP = '2/google_transit.zip'
+GTFS_FILES = ['routes.txt', 'shapes.txt', 'stop_times.txt', 'stops.txt', 'trips.txt']
+# The GTFS files each dataset of the bundle is built from, routes.txt is read by the app directly
+DATASET_INPUTS = {'stop_times': ['stop_times.txt'], 'shapes': ['shapes.txt'],
+                  'stops': ['stops.txt'], 'trips': ['trips.txt']}
 
-with ZipFile('gtfs.zip', 'r') as archive:
-    # Get only Metro VIC data
-    for file in archive.namelist():
-        if file.startswith('2/'):
-            archive.extract(file, '')
+# Seconds taken by each stage of the build, in the order they ran
+timings = {}
 
-with ZipFile('2/google_transit.zip') as inner_archive:
-    # Get routes, shapes, stop_times stations
-    inner_archive.extractall(path='data', members=['routes.txt', 'shapes.txt',
-                                                   'stop_times.txt', 'stops.txt', 'trips.txt'])
 
-shutil.rmtree('2')
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
 
-# Generate stopping sequences (times), drop most details
-stop_times = pd.read_csv("data/stop_times.txt", parse_dates=["arrival_time", "departure_time"]).drop(
-    ['stop_headsign', 'pickup_type',
-        'drop_off_type',
-        'departure_time', 'shape_dist_traveled'], axis=1)
 
-# Serialize by grouping on trip_id, then generate a dictionary indexed trip_id, refactor
-with open('data/stop_times.pkl', 'wb') as pk:
-    pickle.dump(reduce(lambda x, y: x | y,
-                       [{service: data.drop(['trip_id', 'stop_sequence'], axis=1).to_dict('records')} for service, data in stop_times.groupby('trip_id')]), pk)
+def read_meta(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
 
-# Do it again but have random access compatable as opposed to sequence
-with open('data/stop_times_rand.pkl', 'wb') as pk:
-    pickle.dump(reduce(lambda x, y: x | y, [{service: {seq["stop_sequence"]: seq for seq in data.drop(
-        ['trip_id'], axis=1).to_dict('records')}} for service, data in stop_times.groupby('trip_id')]), pk)
 
+def write_meta(path: str, response: requests.Response) -> None:
+    with open(path, 'w') as file:
+        json.dump({'url': GTFS_URL, 'etag': response.headers.get('ETag'),
+                   'last_modified': response.headers.get('Last-Modified')}, file, indent=2)
 
-# Generate dictionary indexed by shape_id
-shapes = pd.read_csv(
-    'data/shapes.txt').drop(['shape_pt_sequence', 'shape_dist_traveled'], axis=1)
 
-# For each unique shape, group together into a sequence of points (forms a line)
-with open('data/shapes.pkl', 'wb') as pkl:
-    pickle.dump(reduce(lambda x, y: x | y,
-                       [{service: data.drop(['shape_id'], axis=1).to_dict('records')} for service, data in shapes.groupby('shape_id')]), pkl)
+def download() -> bool:
+    '''
+    Streams the statewide GTFS zip to disk in chunks, so memory use doesn't grow with the feed.
+    Returns False without downloading anything if the copy we already have is current.
+    '''
+    headers = {}
+    meta = read_meta(GTFS_META) if os.path.exists(GTFS_ZIP) else {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    # Carry on from where an interrupted download stopped, as long as the file hasn't changed since
+    part_meta = read_meta(GTFS_PART_META) if os.path.exists(GTFS_PART) else {}
+    validator = part_meta.get('etag') or part_meta.get('last_modified')
+    if validator:
+        size = os.path.getsize(GTFS_PART)
+        headers['Range'] = f'bytes={size}-'
+        headers['If-Range'] = validator
+
+    with requests.get(GTFS_URL, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            return False
+        # 416 when the part is already the whole file, having stopped just before it was moved into place.
+        # Neither it nor a range that doesn't carry on from the part can be appended, so start again
+        if validator and (response.status_code == 416 or response.status_code == 206 and
+                          not response.headers.get('Content-Range', '').startswith(f'bytes {size}-')):
+            os.remove(GTFS_PART)
+            os.remove(GTFS_PART_META)
+            return download()
+        response.raise_for_status()
+
+        resumed = response.status_code == 206
+        if not resumed:
+            write_meta(GTFS_PART_META, response)
+        with open(GTFS_PART, 'ab' if resumed else 'wb') as file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                file.write(chunk)
+
+    os.replace(GTFS_PART, GTFS_ZIP)
+    os.replace(GTFS_PART_META, GTFS_META)
+    return True
+
+
+def extract() -> None:
+    # The Metro zip is read straight out of the statewide one, without writing it to disk first
+    with ZipFile(GTFS_ZIP) as archive, archive.open(METRO_ZIP) as inner_file, ZipFile(inner_file) as inner_archive:
+        # Get routes, shapes, stop_times stations
+        inner_archive.extractall(path='data', members=GTFS_FILES)
+
+
+def hash_inputs() -> dict[str, str]:
+    hashes = {}
+    for name in GTFS_FILES:
+        digest = hashlib.sha256()
+        with open(os.path.join('data', name), 'rb') as file:
+            while chunk := file.read(CHUNK_SIZE):
+                digest.update(chunk)
+        hashes[name] = digest.hexdigest()
+    return hashes
+
+
+def unchanged_datasets(inputs: dict[str, str]) -> list[str]:
+    '''
+    Datasets of the current bundle that were built from exactly the same files, so can be reused.
+    '''
+    manifest = read_manifest()
+    if manifest is None or manifest['format'] != BUNDLE_FORMAT:
+        return []
+
+    previous = manifest.get('inputs', {})
+    return [dataset for dataset, files in DATASET_INPUTS.items()
+            if dataset in manifest['datasets'] and all(previous.get(name) == inputs[name] for name in files)]
+
+
+def build_stop_times() -> dict[str, np.ndarray]:
+    '''
+    Stopping sequences (times), stored column-wise for src/timetable.py.
+    A single sort puts the rows of each trip together, after which every column is one vectorised pass.
+    '''
+    stop_times = pd.read_csv("data/stop_times.txt", usecols=['trip_id', 'arrival_time', 'stop_id', 'stop_sequence'],
+                             dtype={'trip_id': str, 'arrival_time': str, 'stop_id': str}).sort_values(['trip_id', 'stop_sequence'])
+
+    # The rows of each trip are contiguous once sorted, so a trip is just an offset into the columns
+    trip_ids, starts = np.unique(stop_times['trip_id'].to_numpy(), return_index=True)
+    stop_ids, stops = np.unique(stop_times['stop_id'].to_numpy(), return_inverse=True)
+    # Arrival times as seconds since the start of the service day, these carry over 24:00:00
+    arrival_time = stop_times['arrival_time'].str.strip().str.split(':', expand=True).astype(int)
+
+    return {
+        'trip_ids': trip_ids.astype(str),
+        'offsets': np.append(starts, len(stop_times)).astype(np.int64),
+        'stops': stops.astype(np.int32),
+        'arrivals': (arrival_time[0] * 3600 + arrival_time[1] * 60 + arrival_time[2]).to_numpy(np.int32),
+        'sequences': stop_times['stop_sequence'].to_numpy(np.int32),
+        'stop_ids': stop_ids.astype(str)
+    }
+
+
+def build_shapes() -> dict[str, np.ndarray]:
+    '''
+    Points of each shape in order, laid out the same way as the stop times.
+    '''
+    shapes = pd.read_csv('data/shapes.txt', usecols=['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+                         dtype={'shape_id': str}).sort_values(['shape_id', 'shape_pt_sequence'])
+
+    shape_ids, starts, counts = np.unique(shapes['shape_id'].to_numpy(), return_index=True, return_counts=True)
+    xy = to_xy(shapes['shape_pt_lon'].to_numpy(), shapes['shape_pt_lat'].to_numpy())
+    # Distance along its line of each point, restarting from 0 at the first point of every shape
+    distance = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+    distance -= np.repeat(distance[starts], counts)
+
+    return {
+        'shape_ids': shape_ids.astype(str),
+        'offsets': np.append(starts, len(shapes)).astype(np.int64),
+        'lon': shapes['shape_pt_lon'].to_numpy(np.float64),
+        'lat': shapes['shape_pt_lat'].to_numpy(np.float64),
+        'xy': xy,
+        'distance': distance,
+        # Worked out once here, so simplifying a shape for a zoom level is only a mask
+        'significance': np.concatenate([significance(xy[start:start + count]) for start, count in zip(starts, counts)])
+    }
+
+
+def build_stops() -> dict[str, np.ndarray]:
+    stops_txt = pd.read_csv('data/stops.txt', encoding='utf-8-sig', dtype={'stop_id': str, 'stop_name': str})
+    return {
+        'stop_ids': stops_txt['stop_id'].to_numpy().astype(str),
+        'stop_names': stops_txt['stop_name'].to_numpy().astype(str),
+        'stop_lat': stops_txt['stop_lat'].to_numpy(np.float64),
+        'stop_lon': stops_txt['stop_lon'].to_numpy(np.float64)
+    }
+
+
+def build_trips() -> dict[str, np.ndarray]:
+    trips = pd.read_csv('data/trips.txt', encoding='utf-8-sig', usecols=['trip_id', 'route_id', 'shape_id'], dtype=str).sort_values('trip_id')
+    return {
+        'trip_ids': trips['trip_id'].to_numpy().astype(str),
+        'route_ids': trips['route_id'].to_numpy().astype(str),
+        'shape_ids': trips['shape_id'].to_numpy().astype(str)
+    }
+
+
+def report() -> None:
+    print(f'Built the static data in {sum(timings.values()):.2f}s:')
+    for name, seconds in timings.items():
+        print(f'  {name:<12} {seconds:8.2f}s')
+
+
+if __name__ == '__main__':
+    with stage('download'):
+        changed = download()
+    # Only skip if the current bundle was built from this download. A build that failed after it was
+    # downloaded still has to be redone, as does a bundle in an older format
+    manifest = read_manifest()
+    source = read_meta(GTFS_META)
+    built = manifest is not None and manifest['format'] == BUNDLE_FORMAT and manifest.get('source') == source
+    if not changed and built and '--force' not in sys.argv:
+        print('The GTFS data has not changed since the last build, pass --force to rebuild anyway')
+        sys.exit()
+
+    with stage('extract'):
+        extract()
+    with stage('hash'):
+        inputs = hash_inputs()
+        reuse = [] if '--force' in sys.argv else unchanged_datasets(inputs)
+
+    if len(reuse) == len(DATASET_INPUTS) and manifest['inputs'] == inputs and manifest.get('source') == source:
+        print('None of the GTFS files have changed since the last build')
+        sys.exit()
+
+    datasets = {}
+    for name, build in [('stop_times', build_stop_times), ('shapes', build_shapes),
+                        ('stops', build_stops), ('trips', build_trips)]:
+        if name in reuse:
+            print(f'{name} is unchanged, reusing it from the current bundle')
+            continue
+        with stage(name):
+            datasets[name] = build()
+
+    with stage('write'):
+        write_bundle(datasets, inputs=inputs, reuse=reuse, source=source)
+
+    report()
@@ -0,0 +1,59 @@
+import asyncio
+import hmac
+from os import environ
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi_utils.tasks import repeat_every
+from dotenv import load_dotenv
+
+from src.model import *
+from src import data
+
+load_dotenv()
+
+router = APIRouter()
+
+# How often each worker checks whether get_gtfs.py has written a new bundle, in seconds
+BUNDLE_WATCH_INTERVAL = float(environ.get('BUNDLE_WATCH_INTERVAL', 60))
+
+
+async def reload_data() -> bool:
+    # Loading the new data happens off the event loop, so realtime updates and websockets carry on meanwhile
+    reloaded = await asyncio.get_running_loop().run_in_executor(None, data.reload)
+    if reloaded:
+        print(f"Reloaded the static data from bundle {data.manifest['build']}")
+    return reloaded
+
+
+def static_data(reloaded: bool = False) -> StaticData:
+    return StaticData(build=data.manifest['build'], generation=data.generation, reloaded=reloaded)
+
+
+@router.get('/static', response_model=StaticData)
+async def get_static_data() -> StaticData:
+    return static_data()
+
+
+@router.post('/reload', response_model=StaticData)
+async def post_reload(x_admin_key: str | None = Header(None)) -> StaticData:
+    '''
+    Reloads the static data if get_gtfs.py has built a new bundle, without restarting the server.
+    Only reloads the worker that handles the request, the others pick it up from the file watch.
+
+    '''
+    if not environ.get('AdminKey') or not hmac.compare_digest((x_admin_key or '').encode(), environ['AdminKey'].encode()):
+        raise HTTPException(status_code=403, detail='Invalid admin key')
+    return static_data(await reload_data())
+
+
+@router.on_event("startup")
+@repeat_every(seconds=BUNDLE_WATCH_INTERVAL)
+async def watch_bundle() -> None:
+    '''
+    Reloads the static data whenever get_gtfs.py has written a new bundle.
+    Nothing is loaded unless the manifest differs from the one the data came from, so checking is cheap.
+    '''
+    try:
+        await reload_data()
+    except Exception as e:
+        print(f'Error: reloading the static data failed: {e!r}')
@@ -1,14 +1,26 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from src.realtime import router as RealTime
 from src.shape import router as Shape 
 from src.stops import router as Stops
 from src.misc import router as Misc 
+from src.admin import router as Admin
+from src import data
 
 app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], expose_headers=["X-Stations"])
 
 app.include_router(RealTime, tags=["Realtime"], prefix="/realtime")
 app.include_router(Shape, tags=["Shape"],prefix="/shape")
 app.include_router(Stops, tags=["Stops"],prefix="/stops")
-app.include_router(Misc, tags=["Misc"],prefix="")
\ No newline at end of file
+app.include_router(Misc, tags=["Misc"],prefix="")
+app.include_router(Admin, tags=["Admin"], prefix="/admin")
+
+
+@app.on_event("startup")
+async def warm_up_data() -> None:
+    # In lazy mode, load whatever hasn't been used yet once the server is up, off the event loop
+    if data.LAZY:
+        asyncio.get_running_loop().run_in_executor(None, data.load_all)
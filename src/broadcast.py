@@ -0,0 +1,32 @@
+'''
+Fans realtime updates out to all connected websockets.
+
+'''
+import asyncio
+
+
+class Broadcaster:
+    '''
+    Pushes each payload to every subscriber.
+    The payload is built once by the publisher, and each client only has a small
+    bounded queue, so a slow socket drops its own stale frames instead of stalling the rest.
+    '''
+
+    def __init__(self, queue_size: int = 2):
+        self.queue_size = queue_size
+        self.clients: set[asyncio.Queue] = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.clients.discard(queue)
+
+    def publish(self, payload) -> None:
+        for queue in self.clients:
+            if queue.full():
+                # The new frame supersedes the oldest one the client hasn't sent yet
+                queue.get_nowait()
+            queue.put_nowait(payload)
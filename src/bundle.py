@@ -0,0 +1,99 @@
+'''
+Versioned bundle of the static GTFS data, as fixed-width NumPy arrays.
+
+get_gtfs.py writes each build into its own data/bundle-<build>/ directory as one
+.npy file per column, then points data/bundle.json at it. The app memory-maps the
+columns read-only, so every gunicorn worker shares the same physical pages, and
+since a build never overwrites files that are already mapped, a new bundle can be
+written while the server is running.
+
+The manifest also records a hash of each GTFS file the bundle was built from, so a
+build can carry over the datasets whose inputs haven't changed from the current bundle.
+
+'''
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+# Bump whenever the layout of the arrays changes, so stale bundles are rebuilt rather than misread
+BUNDLE_FORMAT = 2
+BUNDLE_ROOT = 'data'
+
+
+def read_manifest(root: str = BUNDLE_ROOT) -> dict | None:
+    '''
+    The manifest of the current bundle, None if there isn't one yet.
+    '''
+    if not os.path.exists(os.path.join(root, 'bundle.json')):
+        return None
+    with open(os.path.join(root, 'bundle.json')) as file:
+        return json.load(file)
+
+
+def write_bundle(datasets: dict[str, dict[str, np.ndarray]], root: str = BUNDLE_ROOT,
+                 inputs: dict[str, str] | None = None, reuse: list[str] = (), source: dict | None = None) -> str:
+    '''
+    Writes a new bundle and makes it the current one, returning its directory.
+    inputs are the hashes of the files it was built from, source is the ETag and Last-Modified of the
+    download they came from, and the datasets in reuse are taken from the current bundle as they are
+    instead of being written again.
+    '''
+    build = time.strftime('%Y%m%dT%H%M%S')
+    path = os.path.join(root, f'bundle-{build}')
+    os.makedirs(path)
+
+    for dataset, columns in datasets.items():
+        for column, values in columns.items():
+            np.save(os.path.join(path, f'{dataset}.{column}.npy'), np.ascontiguousarray(values))
+
+    columns = {dataset: sorted(dataset_columns) for dataset, dataset_columns in datasets.items()}
+    if reuse:
+        previous = read_manifest(root)
+        for dataset in reuse:
+            columns[dataset] = previous['datasets'][dataset]
+            for column in columns[dataset]:
+                name = f'{dataset}.{column}.npy'
+                # Bundles are never modified once written, so the new one can share the file
+                try:
+                    os.link(os.path.join(root, previous['path'], name), os.path.join(path, name))
+                except OSError:
+                    shutil.copyfile(os.path.join(root, previous['path'], name), os.path.join(path, name))
+
+    manifest = {'format': BUNDLE_FORMAT, 'build': build, 'path': os.path.basename(path),
+                'datasets': columns, 'inputs': inputs or {}, 'source': source or {}}
+    with open(os.path.join(root, 'bundle.json.tmp'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(os.path.join(root, 'bundle.json.tmp'), os.path.join(root, 'bundle.json'))
+
+    # Running workers may still have the previous bundle mapped, so only prune the ones before it
+    for old in sorted(name for name in os.listdir(root) if name.startswith('bundle-'))[:-2]:
+        shutil.rmtree(os.path.join(root, old))
+
+    return path
+
+
+def open_bundle(root: str = BUNDLE_ROOT, manifest: dict | None = None) -> dict[str, dict[str, np.ndarray]]:
+    '''
+    Memory-maps every column of the current bundle, or of the one described by manifest.
+    '''
+    manifest = manifest or read_manifest(root)
+    if manifest is None:
+        raise RuntimeError('There is no static data bundle yet, run get_gtfs.py')
+    if manifest['format'] != BUNDLE_FORMAT:
+        raise RuntimeError(f"Bundle format {manifest['format']} is not {BUNDLE_FORMAT}, rerun get_gtfs.py")
+
+    path = os.path.join(root, manifest['path'])
+    return {dataset: {column: np.load(os.path.join(path, f'{dataset}.{column}.npy'), mmap_mode='r')
+                      for column in columns}
+            for dataset, columns in manifest['datasets'].items()}
+
+
+def find(keys: np.ndarray, key: str) -> int | None:
+    '''
+    Row of key in a sorted column, without building a per-process dict over it.
+    '''
+    i = int(np.searchsorted(keys, key))
+    return i if i < len(keys) and keys[i] == key else None
@@ -0,0 +1,41 @@
+'''
+Least recently used cache of serialized responses, capped by their total size in bytes.
+
+'''
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+
+class ByteCache:
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, bytes] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, build: Callable[[], bytes]) -> bytes:
+        '''
+        The cached value for key, calling build to make it on a miss.
+        '''
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        value = build()
+        if len(value) <= self.max_bytes:
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return value
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'size': self.size, 'max_size': self.max_bytes}
@@ -0,0 +1,60 @@
+'''
+Conditional GET helpers, so polling clients can revalidate with
+If-None-Match / If-Modified-Since and get a 304 instead of the full body.
+
+'''
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, Response
+
+
+def make_etag(kind: str, version: int | str) -> str:
+    '''
+    Strong ETag for a representation that only changes when its version does.
+    '''
+    return f'"{kind}-{version}"'
+
+
+def is_not_modified(request: Request, etag: str, last_modified: int | None = None) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in [tag.removeprefix('W/') for tag in tags]
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None and last_modified:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+def accepts_gzip(request: Request) -> bool:
+    return any(coding.split(';')[0].strip() in ('gzip', '*')
+               for coding in request.headers.get('accept-encoding', '').split(','))
+
+
+def conditional_response(request: Request, body: bytes, etag: str, last_modified: int | None = None,
+                         media_type: str = 'application/json', gzip_body: bytes | None = None) -> Response:
+    '''
+    Returns the pre-serialized body, or an empty 304 if the client's copy is current.
+    If a pre-compressed copy of the body is given, it is sent instead to clients that accept gzip.
+    '''
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if last_modified:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    if gzip_body is not None:
+        headers['Vary'] = 'Accept-Encoding'
+        if accepts_gzip(request):
+            # Each encoding is a different representation, so needs its own strong ETag
+            body = gzip_body
+            headers['ETag'] = etag = etag[:-1] + '-gzip"'
+            headers['Content-Encoding'] = 'gzip'
+
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -0,0 +1,245 @@
+'''
+The static GTFS datasets, loaded once per process and shared by every router.
+
+Routers read them as attributes of this module (data.stop_times, data.shape_data, ...)
+at request time. Each dataset is registered with @dataset along with the function that
+loads it, and how long that took and roughly how much memory it holds is reported at startup.
+
+With LAZY_DATA=1 nothing is loaded at import, so the server starts accepting connections
+straight away. Each dataset is then loaded on first use, and src.app warms the rest up in
+the background once it is serving.
+
+The datasets loaded together from one bundle form a generation. When get_gtfs.py writes a
+new bundle, reload() loads a whole new generation off to the side and then swaps it in with
+a single assignment. Each dataset is read whole from one generation or the other, but
+data.stop_times and then data.stop_data are separate reads that a swap can land between.
+So code reading more than one dataset takes a generation once with current() and reads them
+all from that, passing it on to whatever it calls. Caches derived from the data, like
+stop_positions, are datasets too and start empty again, so they only ever hold results
+built from the generation they belong to.
+
+'''
+import sys
+import threading
+import time
+from os import environ
+
+import numpy as np
+from dotenv import load_dotenv
+
+from src.bundle import open_bundle, read_manifest
+from src.cache import ByteCache
+from src.geometry import Shapes
+from src.timetable import StopTimes, Trips
+
+load_dotenv()
+
+LAZY = environ.get('LAZY_DATA', '0') == '1'
+# Memory the serialized shapes may take up, see src.shape
+SHAPE_CACHE_MB = float(environ.get('SHAPE_CACHE_MB', 64))
+
+# Loaders in the order they are registered, each is passed requires() to get the datasets it depends on
+loaders = {}
+# The current generation, replaced as a whole by reload()
+datasets = {}
+# Bumped on every reload, so anything built from the previous generation can tell it is stale
+generation = 0
+# name -> (seconds to load, approximate bytes, whether those bytes are memory-mapped)
+load_stats = {}
+# Held while loading, so a request and the background warmup never load the same dataset twice
+_loading = threading.RLock()
+# Only one new generation is built at a time
+_reloading = threading.Lock()
+
+
+def dataset(name: str):
+    def register(loader):
+        loaders[name] = loader
+        return loader
+    return register
+
+
+def approximate_size(value, seen: set | None = None) -> int:
+    '''
+    Rough deep size of a dataset in bytes. Arrays count their buffer, memory-mapped or not.
+    '''
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approximate_size(k, seen) + approximate_size(v, seen) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(approximate_size(v, seen) for v in value)
+    if hasattr(value, '__dict__'):
+        return sys.getsizeof(value) + approximate_size(vars(value), seen)
+    return sys.getsizeof(value)
+
+
+def _is_mapped(value) -> bool:
+    if isinstance(value, np.memmap):
+        return True
+    if isinstance(value, dict):
+        return any(_is_mapped(v) for v in value.values())
+    return hasattr(value, '__dict__') and _is_mapped(vars(value))
+
+
+def _load_into(name: str, loaded: dict):
+    if name in loaded:
+        return loaded[name]
+
+    start = time.perf_counter()
+    # Loaders get the datasets they depend on from the same generation
+    value = loaders[name](lambda dependency: _load_into(dependency, loaded))
+    seconds = time.perf_counter() - start
+
+    load_stats[name] = (seconds, approximate_size(value), _is_mapped(value))
+    print(f'Loaded {name} in {seconds:.3f}s, ~{load_stats[name][1] / 1e6:.1f} MB'
+          f'{" (memory-mapped)" if load_stats[name][2] else ""}')
+    loaded[name] = value
+    return value
+
+
+def load(name: str):
+    with _loading:
+        return _load_into(name, datasets)
+
+
+def get(name: str):
+    # Fast path once loaded, no lock needed to read a dict
+    if name in datasets:
+        return datasets[name]
+    return load(name)
+
+
+class Generation:
+    '''
+    One generation of the datasets, read as attributes the same way as this module.
+    Datasets that haven't been loaded yet are loaded into it, so they come from the same bundle as the rest.
+    '''
+
+    def __init__(self, loaded: dict, number: int):
+        self.loaded = loaded
+        self.number = number
+
+    def __getattr__(self, name: str):
+        if name not in loaders:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        if name in self.loaded:
+            return self.loaded[name]
+        with _loading:
+            return _load_into(name, self.loaded)
+
+
+def current() -> Generation:
+    # reload() bumps the number after swapping the datasets, so read in this order it can only be behind
+    # them, and anything built from the generation just looks stale and is rebuilt
+    number = generation
+    return Generation(datasets, number)
+
+
+def load_all() -> None:
+    start = time.perf_counter()
+    for name in loaders:
+        get(name)
+    report(time.perf_counter() - start)
+
+
+def reload() -> bool:
+    '''
+    Loads every dataset from the current bundle and swaps them in at once.
+    Returns False if the bundle hasn't changed since the data was last loaded.
+    '''
+    global datasets, generation
+    with _reloading:
+        if read_manifest() == get('manifest'):
+            return False
+
+        start = time.perf_counter()
+        loaded = {}
+        for name in loaders:
+            _load_into(name, loaded)
+
+        with _loading:
+            datasets = loaded
+            generation += 1
+        report(time.perf_counter() - start)
+        return True
+
+
+def report(seconds: float) -> None:
+    '''
+    Prints how long the static data took to load, slowest dataset first.
+    '''
+    print(f'Static data ready in {seconds:.3f}s{" (lazy)" if LAZY else ""}:')
+    for name, (load_seconds, size, mapped) in sorted(load_stats.items(), key=lambda item: -item[1][0]):
+        print(f'  {name:<16} {load_seconds:8.3f}s {size / 1e6:8.1f} MB{" mapped" if mapped else ""}')
+
+
+def __getattr__(name: str):
+    if name in loaders:
+        return get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@dataset('manifest')
+def load_manifest(requires):
+    return read_manifest()
+
+
+@dataset('bundle')
+def load_bundle(requires):
+    # The static GTFS data, memory-mapped so it is shared between workers
+    return open_bundle(manifest=requires('manifest'))
+
+
+@dataset('stop_data')
+def load_stop_data(requires):
+    stops = requires('bundle')['stops']
+    return {stop_id: {'stop_id': stop_id, 'stop_name': stop_name, 'stop_lat': float(stop_lat), 'stop_lon': float(stop_lon)}
+            for stop_id, stop_name, stop_lat, stop_lon in zip(stops['stop_ids'].tolist(), stops['stop_names'].tolist(),
+                                                               stops['stop_lat'], stops['stop_lon'])}
+
+
+@dataset('route_data')
+def load_route_data(requires):
+    with open('data/routes.txt', 'r') as file:
+        return {r[0]: {'route_id': r[0], 'route_long_name': r[3]}
+                for r in list(map(lambda x: x.split(","), file.read().replace('"', '').split("\n")[1:]))[0:-1]}
+
+
+@dataset('trip_data')
+def load_trip_data(requires):
+    # Route and shape of each trip
+    return Trips(requires('bundle')['trips'])
+
+
+@dataset('stop_times')
+def load_stop_times(requires):
+    # Contains the trip id along with the station ids and the times it stops at them, see src.timetable
+    return StopTimes(requires('bundle')['stop_times'])
+
+
+@dataset('shape_data')
+def load_shape_data(requires):
+    # Contains the line data for each route
+    return Shapes(requires('bundle')['shapes'])
+
+
+@dataset('stop_positions')
+def load_stop_positions(requires):
+    # Distance along the line of each station, by shape and stopping pattern, filled in as trains are placed
+    return {}
+
+
+@dataset('shape_cache')
+def load_shape_cache(requires):
+    # Serialized geometry by shape, tolerance and format, shared by every trip on the shape
+    return ByteCache(int(SHAPE_CACHE_MB * 1e6))
+
+
+if not LAZY:
+    load_all()
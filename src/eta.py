@@ -0,0 +1,86 @@
+'''
+Joins the GTFS-R trip updates onto the timetable, so next stops use predicted arrivals.
+
+'''
+from datetime import datetime
+
+import numpy as np
+
+from src.gtfs_pb2 import FeedMessage, TripUpdate
+from src import data
+
+
+def _stop_index(stop_times, trip_id: str, update: TripUpdate.StopTimeUpdate) -> int | None:
+    rows = stop_times.rows(trip_id)
+
+    matches = []
+    if update.HasField('stop_sequence'):
+        matches = np.flatnonzero(stop_times.sequences[rows] == update.stop_sequence)
+    if not len(matches) and update.HasField('stop_id') and update.stop_id in stop_times.stop_index:
+        matches = np.flatnonzero(stop_times.stops[rows] == stop_times.stop_index[update.stop_id])
+
+    return int(matches[0]) if len(matches) else None
+
+
+def _delay(update: TripUpdate.StopTimeUpdate, scheduled: int, service_day: float) -> int | None:
+    '''
+    Delay in seconds of a single stop time update, taken from its arrival or else its departure.
+    '''
+    for event in (update.arrival, update.departure):
+        if event.HasField('time'):
+            return int(event.time - service_day) - scheduled
+        if event.HasField('delay'):
+            return event.delay
+    return None
+
+
+def predict_arrivals(stop_times, trip_update: TripUpdate) -> np.ndarray | None:
+    '''
+    Predicted arrival of every stop of the trip, as seconds since the start of its service day.
+    Following GTFS-R, a delay carries on to the following stops until the next update.
+    '''
+    trip_id = trip_update.trip.trip_id
+    if trip_id not in stop_times:
+        return None
+
+    start_date = trip_update.trip.start_date or datetime.now().strftime('%Y%m%d')
+    service_day = datetime.strptime(start_date, '%Y%m%d').timestamp()
+    scheduled = stop_times.trip_arrivals(trip_id)
+
+    delays = {}
+    for update in trip_update.stop_time_update:
+        i = _stop_index(stop_times, trip_id, update)
+        if i is None:
+            continue
+        if update.schedule_relationship == TripUpdate.StopTimeUpdate.NO_DATA:
+            delays[i] = 0
+        elif (delay := _delay(update, int(scheduled[i]), service_day)) is not None:
+            delays[i] = delay
+
+    if not delays:
+        return None
+
+    # Position in delays of the latest update at or before each stop, or -1 before the first one
+    stops = sorted(delays)
+    latest = np.full(len(scheduled), -1)
+    latest[stops] = np.arange(len(stops))
+    latest = np.maximum.accumulate(latest)
+    delay = np.where(latest >= 0, np.array([delays[i] for i in stops])[latest], 0)
+
+    # A train can't reach a stop before the one preceding it
+    return np.maximum.accumulate(scheduled + delay).astype(np.int32)
+
+
+def build_predictions(static: data.Generation, update_data: FeedMessage) -> dict[str, np.ndarray]:
+    '''
+    Indexes predicted arrivals by trip_id, built once per refresh of the trip update feed.
+    '''
+    # Every trip is laid out against the same timetable, even if the static data is reloaded meanwhile
+    stop_times = static.stop_times
+    predictions = {}
+    for entity in update_data.entity:
+        predicted = predict_arrivals(stop_times, entity.trip_update)
+        if predicted is not None:
+            predictions[entity.trip_update.trip.trip_id] = predicted
+
+    return predictions
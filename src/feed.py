@@ -0,0 +1,101 @@
+'''
+The current realtime feed state.
+
+Each refresh parses into fresh messages and builds everything derived from them
+off to the side, then replaces `state` in one assignment. Readers should grab
+`feed.state` once and work from that, they never need a lock and never see a
+half-updated feed.
+
+'''
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from src.model import *
+from src.gtfs_pb2 import FeedMessage
+from src.conditional import make_etag
+from src.geometry import Grid, to_xy
+
+# Bodies filtered to a bounding box are kept for this many distinct boxes per snapshot
+MAX_VIEWS = 256
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    '''
+    The realtime services for a single feed refresh, along with the
+    serialized response body so requests don't need to rebuild it.
+    '''
+    timestamp: int
+    services: tuple[Service, ...]
+    body: bytes
+    # Diff against the snapshot this one replaced, see get_realtime_since
+    previous: int = 0
+    delta: bytes = b''
+    full: bytes = b''
+    # The body as text for the websockets, decoded once rather than per client
+    text: str = ''
+    # The JSON of each service, and a grid over the positions of those in Victoria for filtering them to a viewport
+    encoded: tuple[str, ...] = ()
+    grid: Grid | None = None
+    # Bodies already filtered to a bounding box, as bytes and text, by box
+    views: dict = field(default_factory=dict, compare=False, repr=False)
+
+    @property
+    def etag(self) -> str:
+        return make_etag('realtime', self.timestamp)
+
+    def _view(self, bbox: tuple[float, float, float, float]) -> tuple[bytes, str]:
+        if bbox in self.views:
+            return self.views[bbox]
+
+        # The grid's keys are the positions in services of the vehicles on it
+        indices = self.grid.keys[self.grid.in_box(to_xy(bbox[0], bbox[1]), to_xy(bbox[2], bbox[3]))] if self.grid else []
+        text = f'{{"timestamp": {self.timestamp}, "services": [{", ".join(self.encoded[i] for i in indices)}]}}'
+        view = (text.encode(), text)
+        if len(self.views) < MAX_VIEWS:
+            self.views[bbox] = view
+        return view
+
+    def within(self, bbox: tuple[float, float, float, float]) -> bytes:
+        '''
+        The body with only the services inside bbox (min long, min lat, max long, max lat).
+        Only the grid cells overlapping the box are looked at, and the result is shared by every client with the same box.
+        '''
+        return self._view(bbox)[0]
+
+    def within_text(self, bbox: tuple[float, float, float, float]) -> str:
+        return self._view(bbox)[1]
+
+
+@dataclass(frozen=True)
+class TripUpdateSnapshot:
+    '''
+    The serialized trip updates for a single feed refresh.
+    '''
+    timestamp: int
+    body: bytes
+
+    @property
+    def etag(self) -> str:
+        return make_etag('trip-update', self.timestamp)
+
+
+@dataclass(frozen=True)
+class FeedState:
+    # Parsed feeds, these must not be modified once the state is published
+    location_data: FeedMessage
+    update_data: FeedMessage
+    snapshot: Snapshot
+    trip_update_snapshot: TripUpdateSnapshot
+    # Predicted arrival seconds of each trip with a trip update, see src.eta
+    predictions: dict[str, np.ndarray] = field(default_factory=dict)
+    # src.data generation the predictions were built against
+    generation: int = 0
+
+
+_empty = RealTimeData(timestamp=0, services=[]).json()
+state = FeedState(FeedMessage(), FeedMessage(),
+                  Snapshot(0, (), _empty.encode(), text=_empty,
+                           full=RealTimeDelta(timestamp=0, since=0, full=True, services=[], removed=[]).json().encode()),
+                  TripUpdateSnapshot(0, TripUpdates(timestamp='0', trips=[]).json().encode()))
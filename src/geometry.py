@@ -0,0 +1,254 @@
+'''
+Planar geometry for placing points along a line, vectorised with NumPy.
+
+Coordinates are projected to metres with an equirectangular approximation,
+which is plenty accurate over the size of Melbourne.
+
+'''
+import numpy as np
+
+from src.bundle import find
+
+EARTH_RADIUS = 6371008.8
+# The projection is centred on Melbourne
+REFERENCE_LAT = np.radians(-37.8)
+# Width of a web map tile in pixels
+TILE_SIZE = 256
+
+
+def to_xy(lon, lat) -> np.ndarray:
+    '''
+    Projects longitudes and latitudes to an (n, 2) array of metres.
+    '''
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    return np.stack([lon * np.cos(REFERENCE_LAT), lat], axis=-1) * EARTH_RADIUS
+
+
+def zoom_tolerance(zoom: float) -> float:
+    '''
+    Size in metres of a pixel around Melbourne at a web map zoom level, detail finer than that can't be seen.
+    '''
+    return 2 * np.pi * EARTH_RADIUS * np.cos(REFERENCE_LAT) / (TILE_SIZE * 2 ** zoom)
+
+
+def significance(xy: np.ndarray) -> np.ndarray:
+    '''
+    Douglas-Peucker significance of each point of a line in metres: the largest tolerance at which
+    the point is still kept. The line simplified to any tolerance is then just the points with
+    significance >= tolerance, without running the algorithm again. The ends are always kept.
+    '''
+    result = np.zeros(len(xy))
+    result[[0, -1]] = np.inf
+    # Spans still to split, along with the significance of the point that split them off
+    spans = [(0, len(xy) - 1, np.inf)]
+    while spans:
+        start, end, parent = spans.pop()
+        if end - start < 2:
+            continue
+
+        segment = xy[end] - xy[start]
+        relative = xy[start + 1:end] - xy[start]
+        # Distance of each point between the ends from the segment joining them
+        t = np.clip(relative @ segment / max(segment @ segment, 1e-9), 0, 1)
+        gap = relative - t[:, None] * segment
+        offset = np.hypot(gap[:, 0], gap[:, 1])
+
+        i = start + 1 + int(offset.argmax())
+        if offset[i - start - 1] < 1e-6:
+            # The rest of the span is straight, so every point in it can go at any tolerance
+            continue
+        # A point can't outlast the one that split its span, or the simplified lines wouldn't nest
+        result[i] = min(offset[i - start - 1], parent)
+        spans += [(start, i, result[i]), (i, end, result[i])]
+
+    return result
+
+
+def encode_polyline(lon: np.ndarray, lat: np.ndarray, precision: int = 5) -> str:
+    '''
+    Google encoded polyline of the points, vectorised rather than a character at a time.
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    '''
+    values = np.round(np.column_stack([lat, lon]) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=0).ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    # Split each value into 5 bit chunks, least significant first, flagging all but its last chunk with 0x20
+    chunks = (zigzag[:, None] >> (5 * np.arange(7))) & 0x1f
+    count = 1 + ((zigzag[:, None] >> (5 * np.arange(1, 7))) > 0).sum(axis=1)
+    chunks |= np.where(np.arange(7) < count[:, None] - 1, 0x20, 0)
+    return (chunks[np.arange(7) < count[:, None]] + 63).astype(np.uint8).tobytes().decode('ascii')
+
+
+def encode_deltas(lon: np.ndarray, lat: np.ndarray) -> bytes:
+    '''
+    Points as little-endian int32 long, lat pairs in millionths of a degree, each relative to the one before.
+    '''
+    values = np.round(np.column_stack([lon, lat]) * 1e6).astype(np.int64)
+    return np.diff(values, axis=0, prepend=0).astype('<i4').tobytes()
+
+
+class Line:
+    '''
+    A polyline in metres, with the distance along the line of each vertex.
+    Both can be read-only views, the segments are only worked out when locating points.
+    '''
+
+    def __init__(self, xy: np.ndarray, distance: np.ndarray | None = None):
+        self.xy = xy
+        if distance is None:
+            distance = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+        self.distance = distance
+
+    def locate(self, points: np.ndarray, after: float = 0) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Projects all points onto the line in one batch.
+        Returns the distance of each point along the line, and how far each point is from it.
+        Only the part of the line beyond `after` is considered.
+        '''
+        segment = np.diff(self.xy, axis=0)
+        length = np.diff(self.distance)
+
+        relative = points[:, None, :] - self.xy[None, :-1, :]
+        # Position of the closest point on each segment, from 0 at its start to 1 at its end
+        t = np.clip((relative * segment).sum(axis=-1) / np.maximum(length ** 2, 1e-9), 0, 1)
+        gap = relative - t[..., None] * segment
+        offset = np.hypot(gap[..., 0], gap[..., 1])
+        offset[:, self.distance[1:] < after] = np.inf
+
+        nearest = offset.argmin(axis=1)
+        rows = np.arange(len(points))
+        return self.distance[nearest] + t[rows, nearest] * length[nearest], offset[rows, nearest]
+
+    def locate_sequence(self, points: np.ndarray) -> np.ndarray:
+        '''
+        Distance along the line of points visited in order, e.g. the stations of a trip.
+        Each point is only matched past the previous one, so lines that pass a station twice still work.
+        '''
+        along = np.zeros(len(points))
+        after = 0
+        for i in range(len(points)):
+            along[i] = after = self.locate(points[i:i + 1], after)[0][0]
+        return along
+
+
+class Grid:
+    '''
+    Uniform grid over points in metres, for finding the points near somewhere without checking them all.
+    Laid out CSR style like the rest of the static data: the points in cell (i, j) are
+    order[offsets[c]:offsets[c + 1]] where c = i * columns + j, so a run of cells along j is one slice.
+    keys optionally names each point.
+    '''
+
+    def __init__(self, xy: np.ndarray, cell_size: float, keys: list | np.ndarray | None = None):
+        self.xy = xy
+        self.cell_size = cell_size
+        self.keys = keys
+
+        cells = np.floor(xy / cell_size).astype(np.int64) if len(xy) else np.zeros((0, 2), dtype=np.int64)
+        self.origin = cells.min(axis=0) if len(xy) else np.zeros(2, dtype=np.int64)
+        cells -= self.origin
+        self.shape = cells.max(axis=0) + 1 if len(xy) else np.ones(2, dtype=np.int64)
+        cell = cells[:, 0] * self.shape[1] + cells[:, 1]
+
+        self.order = np.argsort(cell, kind='stable')
+        self.offsets = np.searchsorted(cell[self.order], np.arange(self.shape[0] * self.shape[1] + 1))
+        # Corners of the area the cells cover
+        self.low = self.origin * cell_size
+        self.high = (self.origin + self.shape) * cell_size
+
+    def within_box(self, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+        '''
+        Indices of the points in the cells overlapping the box, a superset of those inside it.
+        '''
+        first = np.clip(np.floor(low / self.cell_size).astype(np.int64) - self.origin, 0, self.shape - 1)
+        last = np.clip(np.floor(high / self.cell_size).astype(np.int64) - self.origin, 0, self.shape - 1)
+        if (np.floor(high / self.cell_size) < self.origin).any() or (np.floor(low / self.cell_size) >= self.origin + self.shape).any():
+            return np.zeros(0, dtype=np.int64)
+
+        rows = [self.order[self.offsets[i * self.shape[1] + first[1]]:self.offsets[i * self.shape[1] + last[1] + 1]]
+                for i in range(first[0], last[0] + 1)]
+        return np.concatenate(rows)
+
+    def in_box(self, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+        '''
+        Indices of the points inside the box, in their original order.
+        '''
+        candidates = self.within_box(low, high)
+        xy = self.xy[candidates]
+        return np.sort(candidates[((xy >= low) & (xy <= high)).all(axis=1)])
+
+    def nearest(self, point: np.ndarray, k: int, radius: float = np.inf) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Indices and distances of the k points nearest to point, closest first, only counting those within radius.
+        Searches a box twice as wide each time until it holds k points that are closer than its edge.
+        '''
+        reach = self.cell_size
+        while True:
+            reach = min(reach, radius)
+            candidates = self.within_box(point - reach, point + reach)
+            distance = np.hypot(*(self.xy[candidates] - point).T)
+            # Points within reach are certain to be in the box, those further out may not be
+            found = distance <= reach
+            covers = (point - reach <= self.low).all() and (point + reach >= self.high).all()
+            if found.sum() >= k or reach >= radius or covers:
+                break
+            reach *= 2
+
+        if covers:
+            # Every point is in the box, so the rest only have to be within radius
+            found = distance <= radius
+        candidates, distance = candidates[found], distance[found]
+        closest = np.argsort(distance, kind='stable')[:k]
+        return candidates[closest], distance[closest]
+
+
+class Shapes:
+    '''
+    The line data for each route from the static bundle, laid out like src.timetable.StopTimes: the points of the
+    i-th shape are rows offsets[i]:offsets[i + 1] of the coordinate columns.
+    xy and distance are the points projected to metres and the distance along the line of each,
+    significance is how far each point can be simplified away (see significance()).
+    '''
+
+    def __init__(self, arrays):
+        self.shape_ids = arrays['shape_ids']
+        self.offsets = arrays['offsets']
+        self.lon = arrays['lon']
+        self.lat = arrays['lat']
+        self.xy = arrays['xy']
+        self.distance = arrays['distance']
+        self.significance = arrays['significance']
+
+    def __contains__(self, shape_id: str) -> bool:
+        return find(self.shape_ids, shape_id) is not None
+
+    def rows(self, shape_id: str) -> slice:
+        i = find(self.shape_ids, shape_id)
+        if i is None:
+            raise KeyError(shape_id)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def points(self, shape_id: str, tolerance: float = 0) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Longitudes and latitudes of the shape, leaving out points within tolerance metres of the simplified line.
+        '''
+        rows = self.rows(shape_id)
+        keep = self.significance[rows] >= tolerance
+        return self.lon[rows][keep], self.lat[rows][keep]
+
+    def coords(self, shape_id: str, tolerance: float = 0) -> list[list[float]]:
+        # long lats (!! note the ordering)
+        return np.column_stack(self.points(shape_id, tolerance)).tolist()
+
+    def line(self, shape_id: str) -> Line | None:
+        '''
+        The shape as a Line for placing trains on it, None if it isn't known.
+        '''
+        i = find(self.shape_ids, shape_id)
+        if i is None or self.offsets[i + 1] - self.offsets[i] < 2:
+            return None
+
+        rows = slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+        return Line(self.xy[rows], self.distance[rows])
@@ -1,92 +1,169 @@
-from turfpy.measurement import nearest_point
-from geojson import Point, Feature, FeatureCollection
 from datetime import datetime
-from fastapi import APIRouter, Body
-from src.stops import get_trip_info_data, stop_data
+import numpy as np
+from fastapi import APIRouter, Body, HTTPException
+from src import data
+from src.timetable import seconds_to_time
+from src.shape import trip_shape_id
+from src.geometry import Line, to_xy
+from src import feed
 from src.model import *
 
 router = APIRouter()
 
 
-with open('data/routes.txt', 'r') as file:
-    route_data = {r[0]: {'route_id': r[0], 'route_long_name': r[3]}
-                  for r in list(map(lambda x: x.split(","), file.read().replace('"', '').split("\n")[1:]))[0:-1]}
+# Trains further than this (in metres) from their line are placed by time alone
+MAX_OFFSET = 500
+# Trains this close to a station could be standing at the platform, so time decides if they've left
+AT_STATION = 150
 
-@router.get("/next_station/{trip_id}", response_model=NextStop)
-async def get_current_stop(trip_id: str) -> NextStop:
-    trip_info = await get_trip_info_data(trip_id)
-    stops = trip_info["Trips"]
 
+def service_seconds(arrivals, start_date: str | None = None) -> int:
+    '''
+    The current time in seconds since the start of the trip's service day.
+    Without the start date (YYYYMMDD), a trip still running from yesterday's service day is assumed.
+    '''
     now = datetime.now()
-    current_time = now.strftime("%H:%M:%S")
+    if start_date:
+        return int((now - datetime.strptime(start_date, '%Y%m%d')).total_seconds())
+
+    seconds = now.hour * 3600 + now.minute * 60 + now.second
+    if seconds + 86400 <= arrivals[-1]:
+        # Past midnight, on a service that started the day before
+        seconds += 86400
+    return seconds
+
+
+def next_stop_index(arrivals, start_date: str | None = None) -> int:
+    '''
+    Index of the first stop of the trip that hasn't been arrived at yet.
+    '''
+    return int(np.searchsorted(arrivals, service_seconds(arrivals, start_date)))
+
+
+def trip_arrivals(static: data.Generation, trip_id: str, predictions: dict | None = None):
+    '''
+    Predicted arrivals from the trip update feed if the trip has any, otherwise the timetable.
+    '''
+    scheduled = static.stop_times.trip_arrivals(trip_id)
+    # Predictions from before a reload of the static data may not line up with the new timetable
+    if predictions and trip_id in predictions and len(predictions[trip_id]) == len(scheduled):
+        return predictions[trip_id]
+    return scheduled
 
-    # We want the next station the train will be at
-    i = 0
-    current_stop = stops[i]
-    while (current_time > current_stop['arrival_time']) and (i < len(stops) - 1):
-        i += 1
-        current_stop = stops[i]
 
-    if (i == len(stops) - 1):
+def stop_response(static: data.Generation, trip_id: str, i: int, arrivals) -> NextStop:
+    stops = static.stop_times.trip_stop_ids(trip_id)
+
+    if (i >= len(stops) - 1):
         # The route is completed so we return None
         return {
             'next_stop': None,
             'arrival': None
         }
 
-    stop_id = str(current_stop['stop_id'])
-
     return {
-        'next_stop': stop_data[stop_id]['stop_name'],
-        'arrival': current_stop['arrival_time']
+        'next_stop': static.stop_data[stops[i]]['stop_name'],
+        'arrival': seconds_to_time(int(arrivals[i]))
     }
 
-async def get_next_stop(trip_id: str, lat_lon: list[float]) -> NextStop:
+
+def next_stop(static: data.Generation, trip_id: str, start_date: str | None = None,
+              predictions: dict | None = None) -> NextStop:
     '''
-    Implements getting next station, given position and trip_id
+    Next station of the trip, going by time alone.
+    '''
+    arrivals = trip_arrivals(static, trip_id, predictions)
 
-    use turfpy
-    Put stations along line
-    Find point closest to line  
-    Set max(numstations, nextpoint) as next station
-    this will break for if train is very close to next station, so use time as failsafe
-    if time below assume havent reached station, else assume past station
-    ''' 
-    trip_info = await get_trip_info_data(trip_id)
-    stops = trip_info["Trips"]
+    # We want the next station the train will be at
+    return stop_response(static, trip_id, next_stop_index(arrivals, start_date), arrivals)
 
-    fc = FeatureCollection([Feature(geometry=Point(stop_coord)) for stop_coord in stops])
 
-    now = datetime.now()
-    current_time = now.strftime("%H:%M:%S")
+def stop_positions(static: data.Generation, shape_id: str, line: Line, trip_id: str) -> np.ndarray:
+    key = (shape_id, static.stop_times.trip_stops(trip_id).tobytes())
 
-    # We want the next station the train will be at
-    i = 0
-    current_stop = stops[i]
-    while (current_time > current_stop['arrival_time']) and (i < len(stops) - 1):
-        i += 1
-        current_stop = stops[i]
+    if key not in static.stop_positions:
+        stations = [static.stop_data[stop_id] for stop_id in static.stop_times.trip_stop_ids(trip_id)]
+        static.stop_positions[key] = line.locate_sequence(
+            to_xy([station['stop_lon'] for station in stations], [station['stop_lat'] for station in stations]))
+    return static.stop_positions[key]
 
-    if (i == len(stops) - 1):
-        # The route is completed so we return None
-        return {
-            'next_stop': None,
-            'arrival': None
-        }
 
-    stop_id = str(current_stop['stop_id'])
+def next_stops(static: data.Generation, vehicles: list[tuple[str, str | None, float, float]],
+               predictions: dict | None = None) -> list[NextStop]:
+    '''
+    Next station of each (trip_id, start_date, latitude, longitude), going by where the train is along its line.
+
+    All trains on the same line are projected onto it in one batch.
+    The next station is the first one ahead of the train, unless it's close enough to a station
+    that it could be at the platform; then time decides whether it has arrived there yet.
+    Trains that are off their line, or whose line isn't known, fall back to time alone.
+    Trips that aren't in the timetable have no next station.
+    Everything is read from the one generation of the static data, see src.data.
+    '''
+    known = [trip_id in static.stop_times for trip_id, *_ in vehicles]
+    arrivals = [trip_arrivals(static, trip_id, predictions) if ok else None for (trip_id, *_), ok in zip(vehicles, known)]
+    indices = [next_stop_index(arrival, start_date) if ok else None
+               for arrival, (_, start_date, *_), ok in zip(arrivals, vehicles, known)]
 
-    return {
-        'next_stop': stop_data[stop_id]['stop_name'],
-        'arrival': current_stop['arrival_time']}
+    by_shape = {}
+    for i, (trip_id, *_) in enumerate(vehicles):
+        if known[i]:
+            by_shape.setdefault(trip_shape_id(static, trip_id), []).append(i)
+
+    for shape_id, members in by_shape.items():
+        line = static.shape_data.line(shape_id)
+        if line is None:
+            continue
 
+        along, offset = line.locate(
+            to_xy([vehicles[i][3] for i in members], [vehicles[i][2] for i in members]))
+
+        for i, distance, gap in zip(members, along, offset):
+            if gap > MAX_OFFSET:
+                continue
+
+            stations = stop_positions(static, shape_id, line, vehicles[i][0])
+            ahead = int(np.searchsorted(stations, distance))
+            near = [k for k in (ahead - 1, ahead) if 0 <= k < len(stations) and abs(stations[k] - distance) < AT_STATION]
+            if near:
+                # if time below assume havent reached station, else assume past station
+                indices[i] = near[0] if indices[i] <= near[0] else near[0] + 1
+            else:
+                indices[i] = ahead
+
+    return [stop_response(static, trip_id, i, arrival) if ok else {'next_stop': None, 'arrival': None}
+            for (trip_id, *_), i, arrival, ok in zip(vehicles, indices, arrivals, known)]
+
+
+@router.get("/next_station/{trip_id}", response_model=NextStop)
+async def get_current_stop(trip_id: str, start_date: str | None = None) -> NextStop:
+    return next_stop(data.current(), trip_id, start_date, feed.state.predictions)
+
+async def get_next_stop(trip_id: str, lat_lon: list[float], start_date: str | None = None) -> NextStop:
+    '''
+    Implements getting next station, given position and trip_id
+
+    Put stations along line
+    Find point closest to line
+    Set the first station past that point as next station
+    this will break for if train is very close to next station, so use time as failsafe
+    if time below assume havent reached station, else assume past station
+
+    See next_stops, which does this for a whole batch of trains.
+    '''
+    return next_stops(data.current(), [(trip_id, start_date, *lat_lon)], feed.state.predictions)[0]
 
 
 @router.get("/train_line/{trip_id}", response_model=TrainLine)
 async def get_train_line(trip_id: str) -> TrainLine:
-    for key in route_data:
-        if key in trip_id:
-            return {
-                'trip_id': trip_id,
-                'line_name': route_data[key]['route_long_name']
-            }
+    static = data.current()
+    if trip_id not in static.trip_data:
+        raise HTTPException(status_code=404, detail=f'Unknown trip {trip_id}')
+
+    trip = static.trip_data[trip_id]
+    return {
+        'trip_id': trip_id,
+        'line_name': static.route_data[trip['route_id']]['route_long_name'],
+        'route_id': trip['route_id'],
+        'shape_id': trip['shape_id']
+    }
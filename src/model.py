@@ -12,6 +12,21 @@ class Stops(BaseModel):
     stop_list: list[Stop]
 
 
+class NearbyStop(Stop):
+    distance: float = Field(..., description='Metres from the given position')
+
+
+class NearbyStops(BaseModel):
+    # Closest first
+    stop_list: list[NearbyStop]
+
+
+class StopsFormat(str, Enum):
+    JSON = 'json'
+    # A GeoJSON FeatureCollection of the stops as points, with their name and station_id as properties
+    GEOJSON = 'geojson'
+
+
 class TripShape(BaseModel):
 
     # line file, list of long lats (!! note the ordering)
@@ -19,6 +34,58 @@ class TripShape(BaseModel):
     stations: list[str]
 
 
+class ShapeFormat(str, Enum):
+    '''
+    How the line of a shape is sent.
+    '''
+    # shape_file as a list of long lats
+    JSON = 'json'
+    # shape_file as a Google encoded polyline string, which orders each point lat, long
+    POLYLINE = 'polyline'
+    # The body is little-endian int32 pairs of long, lat in millionths of a degree, each the difference
+    # from the previous point (the first from 0), the stations are comma separated in the X-Stations header
+    BINARY = 'binary'
+
+
+class EncodedTripShape(BaseModel):
+
+    # line file as an encoded polyline
+    shape_file: str
+    stations: list[str]
+
+
+class ShapeBatchRequest(BaseModel):
+    trip_ids: list[str] = Field(..., max_items=500)
+    zoom: float | None = Field(None, ge=0, le=22, description='Web map zoom level to simplify the lines for')
+    tolerance: float | None = Field(None, ge=0, description='Metres the simplified lines may stray from the shapes')
+    # Binary isn't supported, as the lines are sent together in one JSON body
+    format: ShapeFormat = ShapeFormat.JSON
+
+
+class TripShapeRef(BaseModel):
+    # None if the trip isn't known
+    shape_id: str | None
+    stations: list[str]
+
+
+class ShapeBatch(BaseModel):
+    '''
+    Lines of several trips, each shape only sent once however many of the trips run along it.
+    '''
+    # shape_id -> line, as in TripShape or EncodedTripShape
+    shapes: dict[str, list[list[float]] | str]
+    trips: dict[str, TripShapeRef]
+
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    size: int = Field(..., description='Bytes cached')
+    max_size: int = Field(..., description='Bytes that may be cached before the least recently used are evicted')
+
+
 class TripStop(BaseModel):
     arrival_time: str
     stop_id: str
@@ -86,6 +153,20 @@ class RealTimeData(BaseModel):
     services: list[Service]
 
 
+class RealTimeDelta(BaseModel):
+    '''
+    Services that changed since a previous feed timestamp.
+    If full is set, the given timestamp is too old (since is 0) and services holds every running train.
+
+    '''
+    timestamp: int
+    since: int
+    full: bool
+    services: list[Service] = Field(...,
+                                    description='Services whose position, next stop, occupancy or timestamp changed')
+    removed: list[str] = Field(..., description='Vehicle ids no longer in the feed')
+
+
 class EstService(BaseModel):
     trip_id: str
     start_time: str
@@ -127,3 +208,26 @@ class CarParkOccupancy(int):
 class TrainLine(BaseModel):
     trip_id: str
     line_name: str
+    route_id: str
+    shape_id: str
+
+
+class FeedFetch(BaseModel):
+    '''
+    Outcome of the latest upstream fetch of a realtime feed.
+    '''
+    feed: str
+    ok: bool
+    latency: float = Field(..., description='Seconds taken to download the feed')
+    fetched_at: int = Field(..., description='Epoch Timestamp')
+    size: int | None = Field(None, description='Bytes downloaded')
+    error: str | None
+
+
+class StaticData(BaseModel):
+    '''
+    Which static GTFS bundle the server is serving.
+    '''
+    build: str = Field(..., description='Build of the bundle, from get_gtfs.py')
+    generation: int = Field(..., description='Times the static data has been reloaded since startup')
+    reloaded: bool = Field(False, description='Whether this request loaded a new bundle')
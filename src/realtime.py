@@ -1,47 +1,118 @@
 from os import environ
 import aiohttp
 import asyncio
-from fastapi import APIRouter, Body, WebSocket
+import json
+import math
+import time
+from fastapi import APIRouter, Body, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.encoders import jsonable_encoder
 from fastapi_utils.tasks import repeat_every
+import numpy as np
 from dotenv import load_dotenv
 
 from src.model import *
 from src.gtfs_pb2 import FeedMessage
-from src.misc import get_current_stop
+from src.misc import next_stops
+from src.eta import build_predictions
+from src.conditional import conditional_response, make_etag
+from src import data, feed
+from src.feed import FeedState, Snapshot, TripUpdateSnapshot
+from src.broadcast import Broadcaster
+from src.geometry import Grid, to_xy
 
 router = APIRouter()
 
-location_data = FeedMessage()
-update_data = FeedMessage()
+# Websocket clients, notified by update_realtime with each new Snapshot
+broadcaster = Broadcaster()
 
-# define API urls
-GTFS_R = 'https://data-exchange-api.vicroads.vic.gov.au/opendata/v1/gtfsr/metrotrain-vehicleposition-updates'
-GTFS_T = 'https://data-exchange-api.vicroads.vic.gov.au/opendata/v1/gtfsr/metrotrain-tripupdates'
+# Side of a cell of the grid over the vehicles in metres
+VEHICLE_GRID_CELL = 2000
+# Only vehicles inside Victoria are put on the grid, a missing position reads as (0, 0) and would stretch it across the globe
+VEHICLE_BOUNDS = (140.9, -39.2, 150.0, -33.9)
+BBOX_DESCRIPTION = 'Only the services inside minLon,minLat,maxLon,maxLat'
 
 # Get token
 load_dotenv()
 
+# define API urls, these can be pointed at a local stand-in for testing
+GTFS_R = environ.get('GTFS_R_URL', 'https://data-exchange-api.vicroads.vic.gov.au/opendata/v1/gtfsr/metrotrain-vehicleposition-updates')
+GTFS_T = environ.get('GTFS_T_URL', 'https://data-exchange-api.vicroads.vic.gov.au/opendata/v1/gtfsr/metrotrain-tripupdates')
 
-@router.get("/", response_model=RealTimeData)
-async def get_realtime() -> RealTimeData:
+# Per feed, so a slow trip update response can't hold up the vehicle positions
+FEED_TIMEOUT = aiohttp.ClientTimeout(total=float(environ.get('FEED_TIMEOUT', 10)))
+
+# Shared between refreshes so the connections are kept alive, see get_session
+session: aiohttp.ClientSession | None = None
+
+# Latest fetch for each feed, served by /fetch_stats
+fetch_stats: dict[str, FeedFetch] = {}
+
+
+def _changes(service: Service) -> tuple:
+    return (service.latitude, service.longitude, service.next_stop, service.occupancy, service.timestamp)
+
+
+def _delta_body(timestamp: int, since: int, full: bool, services: list[str], removed: list[str]) -> bytes:
+    return (f'{{"timestamp": {timestamp}, "since": {since}, "full": {json.dumps(full)}, '
+            f'"services": [{", ".join(services)}], "removed": {json.dumps(removed)}}}').encode()
+
+
+def parse_bbox(bbox: str | None) -> tuple[float, float, float, float] | None:
     '''
-    Returns realtime GTFS data. Updated every 20 seconds.
+    Parses minLon,minLat,maxLon,maxLat, raising ValueError if it isn't a valid box.
+    '''
+    if bbox is None:
+        return None
+
+    min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(','))
+    if not all(map(math.isfinite, (min_lon, min_lat, max_lon, max_lat))):
+        raise ValueError(f'{bbox} is not finite')
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError(f'{bbox} is not a bounding box')
+    return min_lon, min_lat, max_lon, max_lat
 
+
+def build_snapshot(static: data.Generation, location_data: FeedMessage, predictions: dict,
+                   previous: Snapshot | None = None) -> Snapshot:
+    '''
+    Builds the realtime services from a parsed feed, validating and serializing them once.
+    Each service is encoded once and spliced into both the full body and the diff against previous.
     '''
+    vehicles = [(f.vehicle.trip.trip_id, f.vehicle.trip.start_date, f.vehicle.position.latitude, f.vehicle.position.longitude)
+                for f in location_data.entity]
+    services = tuple([Service(**{'service_id': f.id, "trip_id": f.vehicle.trip.trip_id,
+                                 "start_time": f.vehicle.trip.start_time, "start_date": f.vehicle.trip.start_date,
+                                 "latitude": f.vehicle.position.latitude, "longitude": f.vehicle.position.longitude,
+                                 "timestamp": f.vehicle.timestamp, "vehicle_id": f.vehicle.vehicle.id,
+                                 "occupancy": f.vehicle.occupancy_status if hasattr(f.vehicle, "occupancy_status") else None}
+                              | stop) for f, stop in zip(location_data.entity, next_stops(static, vehicles, predictions))])
+    encoded = tuple([service.json() for service in services])
+    timestamp = location_data.header.timestamp
+    text = f'{{"timestamp": {timestamp}, "services": [{", ".join(encoded)}]}}'
+    body = text.encode()
+    full = _delta_body(timestamp, 0, True, encoded, [])
+    min_lon, min_lat, max_lon, max_lat = VEHICLE_BOUNDS
+    placed = [i for i, f in enumerate(location_data.entity)
+              if f.vehicle.HasField('position') and min_lon <= f.vehicle.position.longitude <= max_lon
+              and min_lat <= f.vehicle.position.latitude <= max_lat]
+    grid = Grid(to_xy([services[i].longitude for i in placed], [services[i].latitude for i in placed]).reshape(-1, 2),
+                VEHICLE_GRID_CELL, np.array(placed, dtype=np.int64))
 
-    return {'timestamp': location_data.header.timestamp,
-            'services': [{'service_id': f.id, "trip_id": f.vehicle.trip.trip_id,
-                          "start_time": f.vehicle.trip.start_time, "start_date": f.vehicle.trip.start_date,
-                         "latitude": f.vehicle.position.latitude, "longitude": f.vehicle.position.longitude,
-                          "timestamp": f.vehicle.timestamp, "vehicle_id": f.vehicle.vehicle.id,
-                          "occupancy": f.vehicle.occupancy_status if hasattr(f.vehicle, "occupancy_status") else None } 
-                          | await get_current_stop(f.vehicle.trip.trip_id) for f in location_data.entity]}
+    if previous is None:
+        return Snapshot(timestamp, services, body, full=full, text=text, encoded=encoded, grid=grid)
 
-@router.get("/trip_update", response_model=TripUpdates)
-async def get_trip_update() -> TripUpdates:
-    #print(update_data)
-    return {
+    before = {service.vehicle_id: _changes(service) for service in previous.services}
+    changed = [encoded[i] for i, service in enumerate(services) if before.get(service.vehicle_id) != _changes(service)]
+    running = {service.vehicle_id for service in services}
+    removed = [vehicle_id for vehicle_id in before if vehicle_id not in running]
+
+    return Snapshot(timestamp, services, body, previous=previous.timestamp,
+                    delta=_delta_body(timestamp, previous.timestamp, False, changed, removed), full=full,
+                    text=text, encoded=encoded, grid=grid)
+
+
+def build_trip_update_snapshot(update_data: FeedMessage) -> TripUpdateSnapshot:
+    trips = {
         'timestamp': update_data.header.timestamp,
         'trips': [
             {'trip_id': curr.trip_update.trip.trip_id, 'start_time': curr.trip_update.trip.start_time, 'start_date': curr.trip_update.trip.start_date,
@@ -50,6 +121,90 @@ async def get_trip_update() -> TripUpdates:
         ]
     }
 
+    return TripUpdateSnapshot(update_data.header.timestamp, TripUpdates(**trips).json().encode())
+
+
+@router.get("/", response_model=RealTimeData)
+async def get_realtime(request: Request, bbox: str | None = Query(None, description=BBOX_DESCRIPTION)) -> RealTimeData:
+    '''
+    Returns realtime GTFS data. Updated every 20 seconds.
+    Supports If-None-Match / If-Modified-Since, keyed on the feed timestamp.
+
+    '''
+    try:
+        box = parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f'Invalid bbox: {e}')
+
+    current = feed.state.snapshot
+    if box is None:
+        return conditional_response(request, current.body, current.etag, current.timestamp)
+    return conditional_response(request, current.within(box), make_etag(f'realtime-{"_".join(map(str, box))}', current.timestamp),
+                                current.timestamp)
+
+
+@router.get("/since/{timestamp}", response_model=RealTimeDelta)
+async def get_realtime_since(request: Request, timestamp: int) -> RealTimeDelta:
+    '''
+    Returns only the services that changed since the given RealTimeData timestamp,
+    along with the vehicle ids that have left the feed.
+    If that timestamp is no longer the previous version, every service is returned with full set.
+
+    '''
+    current = feed.state.snapshot
+    if timestamp == current.timestamp:
+        body = _delta_body(current.timestamp, timestamp, False, [], [])
+    elif timestamp == current.previous:
+        body = current.delta
+    else:
+        body = current.full
+
+    return conditional_response(request, body, make_etag(f'delta-{timestamp}', current.timestamp), current.timestamp)
+
+
+@router.get("/trip_update", response_model=TripUpdates)
+async def get_trip_update(request: Request) -> TripUpdates:
+    current = feed.state.trip_update_snapshot
+    return conditional_response(request, current.body, current.etag, current.timestamp)
+
+
+def get_session() -> aiohttp.ClientSession:
+    global session
+
+    if session is None or session.closed:
+        # Keep idle connections around for longer than the refresh interval
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(keepalive_timeout=60),
+                                        headers={'Ocp-Apim-Subscription-Key': environ['PrimaryKey']})
+    return session
+
+
+async def fetch_feed(name: str, url: str) -> bytes:
+    '''
+    Downloads a single feed, recording how long it took.
+    '''
+    start = time.perf_counter()
+    try:
+        async with get_session().get(url, timeout=FEED_TIMEOUT) as response:
+            response.raise_for_status()
+            content = await response.read()
+    except Exception as e:
+        fetch_stats[name] = FeedFetch(feed=name, ok=False, latency=time.perf_counter() - start,
+                                      fetched_at=int(time.time()), error=repr(e))
+        raise
+
+    fetch_stats[name] = FeedFetch(feed=name, ok=True, latency=time.perf_counter() - start,
+                                  fetched_at=int(time.time()), size=len(content))
+    return content
+
+
+@router.get("/fetch_stats", response_model=dict[str, FeedFetch])
+async def get_fetch_stats() -> dict[str, FeedFetch]:
+    '''
+    Returns the latency of the most recent upstream fetch for each feed.
+
+    '''
+    return fetch_stats
+
 
 @router.on_event("startup")
 @repeat_every(seconds=20)
@@ -57,25 +212,103 @@ async def update_realtime() -> None:
     '''
     Updates in realtime.
     The data stores the timestamp which can be used for updates.
+    Both feeds are fetched concurrently, and a failure in one doesn't stop the other updating.
     '''
+    locations, updates = await asyncio.gather(fetch_feed('vehicle_position', GTFS_R),
+                                              fetch_feed('trip_update', GTFS_T), return_exceptions=True)
+    previous = feed.state
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(GTFS_R, headers={'Ocp-Apim-Subscription-Key': environ['PrimaryKey']}) as response:
-            location_data.ParseFromString(await response.read())
-        async with session.get(GTFS_T, headers={'Ocp-Apim-Subscription-Key': environ['PrimaryKey']}) as response:
-            new_stream = await response.read()
-            update_data.ParseFromString(new_stream)
+    # Parse into fresh messages, readers may still be using the previous ones
+    location_data = previous.location_data
+    if isinstance(locations, Exception):
+        print(f'Error: {locations!r}')
+    else:
+        location_data = FeedMessage.FromString(locations)
 
+    update_data = previous.update_data
+    if isinstance(updates, Exception):
+        print(f'Error: {updates!r}')
+    else:
+        update_data = FeedMessage.FromString(updates)
 
-@router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept() # Open connection
+    # The feed timestamp identifies each version, so only rebuild when it moves
+    # One generation of the static data for the whole refresh, which a reload meanwhile doesn't change
+    static = data.current()
+    generation = static.number
+    # A failure building one half is printed and that half keeps its previous version, the other still updates
+    predictions = previous.predictions
+    trip_update_snapshot = previous.trip_update_snapshot
+    try:
+        if update_data.header.timestamp != trip_update_snapshot.timestamp:
+            predictions = build_predictions(static, update_data)
+            trip_update_snapshot = build_trip_update_snapshot(update_data)
+        elif generation != previous.generation:
+            # Predictions are laid out like the timetable they were built from, which has just been replaced
+            predictions = build_predictions(static, update_data)
+    except Exception as e:
+        print(f'Error: building trip updates failed: {e!r}')
+        update_data, predictions, trip_update_snapshot = previous.update_data, previous.predictions, previous.trip_update_snapshot
 
-    while True:
+    snapshot = previous.snapshot
+    if location_data.header.timestamp != snapshot.timestamp:
         try:
-            await asyncio.sleep(10) # Send new every 10 
-            await websocket.send_json(await get_realtime())
+            snapshot = build_snapshot(static, location_data, predictions, snapshot)
         except Exception as e:
-            print(f'Error: {e}')
-            break 
-    # Halt WS connection
+            print(f'Error: building the realtime snapshot failed: {e!r}')
+            location_data = previous.location_data
+
+    feed.state = FeedState(location_data, update_data, snapshot, trip_update_snapshot, predictions, generation)
+
+    if snapshot is not previous.snapshot:
+        broadcaster.publish(snapshot)
+
+
+@router.on_event("shutdown")
+async def close_session() -> None:
+    if session is not None:
+        await session.close()
+
+
+def _frame(snapshot: Snapshot, box: tuple[float, float, float, float] | None) -> str:
+    # Both are encoded once per snapshot and shared by every client
+    return snapshot.text if box is None else snapshot.within_text(box)
+
+
+async def _push_updates(websocket: WebSocket, queue: asyncio.Queue, box: tuple[float, float, float, float] | None) -> None:
+    await websocket.send_text(_frame(feed.state.snapshot, box))
+    while True:
+        await websocket.send_text(_frame(await queue.get(), box))
+
+
+async def _wait_for_close(websocket: WebSocket) -> None:
+    # Clients don't send anything, but receiving is how we notice them leaving
+    while True:
+        await websocket.receive_text()
+
+
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, bbox: str | None = None):
+    '''
+    Sends the current realtime data, then every new version as soon as the feed refreshes.
+    With bbox=minLon,minLat,maxLon,maxLat, only the services inside it are sent.
+    '''
+    try:
+        box = parse_bbox(bbox)
+    except ValueError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept() # Open connection
+    queue = broadcaster.subscribe()
+    tasks = [asyncio.create_task(_push_updates(websocket, queue, box)), asyncio.create_task(_wait_for_close(websocket))]
+
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                print(f'Error: {task.exception()}')
+    finally:
+        # Halt WS connection
+        for task in tasks:
+            task.cancel()
+        broadcaster.unsubscribe(queue)
@@ -1,29 +1,106 @@
-import pickle
+import json
 from os import environ
 
-from fastapi import APIRouter, Body
+import numpy as np
+from fastapi import APIRouter, Body, HTTPException, Query, Response
 from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 
 from src.model import *
+from src import data
+from src.geometry import encode_deltas, encode_polyline, zoom_tolerance
 
 
 router = APIRouter()
 
-with open('data/stop_times.pkl', 'rb') as file:
-    trip_stop_data = pickle.load(file)
 
-# Contains the line data for each route
-with open('data/shapes.pkl', 'rb') as file:
-    shape_data = pickle.load(file)
+def trip_shape_id(static: data.Generation, trip_id: str) -> str:
+    if trip_id in static.trip_data:
+        return static.trip_data[trip_id]['shape_id']
 
-
-@router.get('/{trip_id}', response_model=TripShape)
-async def get_shape(trip_id: str) -> TripShape:
     # the shape id is within the trip_id
+    return ".".join(trip_id.split('.')[2:])
+
+
+def shape_geometry(static: data.Generation, shape_id: str | None, tolerance: float, format: ShapeFormat) -> bytes:
+    '''
+    The serialized line of a shape, which is the bulk of the response and the same for every trip on it.
+    Unknown shapes have an empty line.
+    '''
+    def build() -> bytes:
+        lon, lat = static.shape_data.points(shape_id, tolerance) if shape_id is not None and shape_id in static.shape_data else ([], [])
+        if format == ShapeFormat.BINARY:
+            return encode_deltas(lon, lat)
+        if format == ShapeFormat.POLYLINE:
+            return json.dumps(encode_polyline(lon, lat)).encode()
+        return json.dumps(np.column_stack([lon, lat]).tolist(), separators=(',', ':')).encode()
+
+    # The cache belongs to the same generation as the shapes, so it never holds lines from another bundle
+    return static.shape_cache.get((shape_id, tolerance, format), build)
+
+
+@router.get('/cache_stats', response_model=CacheStats)
+async def get_cache_stats() -> CacheStats:
+    return data.shape_cache.stats()
+
+
+@router.post('/batch', response_model=ShapeBatch)
+async def get_shapes(batch: ShapeBatchRequest) -> Response:
+    '''
+    Return the lines and stations of many trips in one request.
+    Trips are mapped to their shape_id, so lines shared by several trips are only sent once.
+
+    '''
+    if batch.format == ShapeFormat.BINARY:
+        raise HTTPException(status_code=400, detail='The binary format is only available from /shape/{trip_id}')
+
+    tolerance = batch.tolerance
+    if tolerance is None:
+        tolerance = zoom_tolerance(batch.zoom) if batch.zoom is not None else 0
+
+    static = data.current()
+    shapes = {}
+    trips = {}
+    for trip_id in batch.trip_ids:
+        if trip_id not in static.stop_times:
+            trips[trip_id] = {'shape_id': None, 'stations': []}
+            continue
+
+        shape_id = trip_shape_id(static, trip_id)
+        trips[trip_id] = {'shape_id': shape_id, 'stations': static.stop_times.trip_stop_ids(trip_id)}
+        if shape_id not in shapes:
+            shapes[shape_id] = shape_geometry(static, shape_id, tolerance, batch.format)
+
+    # As with a single shape, the cached lines are spliced in as they are
+    shapes_json = b','.join(json.dumps(shape_id).encode() + b':' + geometry for shape_id, geometry in shapes.items())
+    return Response(b'{"shapes":{' + shapes_json + b'},"trips":' + json.dumps(trips).encode() + b'}',
+                    media_type='application/json')
+
+
+@router.get('/{trip_id}', response_model=TripShape | EncodedTripShape)
+async def get_shape(trip_id: str,
+                    zoom: float | None = Query(None, ge=0, le=22, description='Web map zoom level to simplify the line for'),
+                    tolerance: float | None = Query(None, ge=0, description='Metres the simplified line may stray from the shape'),
+                    format: ShapeFormat = ShapeFormat.JSON) -> Response:
+    '''
+    Return the line a trip runs along and its stations.
+    With zoom or tolerance, the line is simplified (Douglas-Peucker) to leave out detail too fine to see.
+    The polyline and binary formats are far smaller than the default list of long lats, see ShapeFormat.
+
+    '''
+    if tolerance is None:
+        tolerance = zoom_tolerance(zoom) if zoom is not None else 0
 
-    shape_id = ".".join(trip_id.split('.')[2:])
-    if trip_id not in trip_stop_data:
-        return {'stations': [], 'shape_file': []}
+    static = data.current()
+    shape_id = None
+    stations = []
+    if trip_id in static.stop_times:
+        shape_id = trip_shape_id(static, trip_id)
+        stations = static.stop_times.trip_stop_ids(trip_id)
+    geometry = shape_geometry(static, shape_id, tolerance, format)
 
-    return {'stations': [station['stop_id'] for station in trip_stop_data[trip_id]], 'shape_file': [[coord['shape_pt_lon'], coord['shape_pt_lat']] for coord in shape_data[shape_id]]}
+    # Only the stations are put together per trip, the cached line is spliced in as is
+    if format == ShapeFormat.BINARY:
+        return Response(geometry, media_type='application/octet-stream', headers={'X-Stations': ','.join(stations)})
+    return Response(b'{"shape_file":' + geometry + b',"stations":' + json.dumps(stations).encode() + b'}',
+                    media_type='application/json')
@@ -1,39 +1,97 @@
-import pickle
+import gzip
+import hashlib
+import json
+from dataclasses import dataclass
 from os import environ
 
-from fastapi import APIRouter, Body
+import numpy as np
+from fastapi import APIRouter, Body, Query, Request, Response
 from fastapi.encoders import jsonable_encoder
 
 from src.model import *
+from src import data
+from src.conditional import conditional_response, make_etag
+from src.geometry import Grid, to_xy
 
 
-with open('data/stops.txt', 'r') as file:
-    stop_data = {r[0]: {'stop_id': r[0], 'stop_name': r[1], 'stop_lat': r[2], 'stop_lon': r[3]}
-                 for r in list(map(lambda x: x.split(","), file.read().replace('"', '').split("\n")[1:]))[0:-1]}
+router = APIRouter()
 
-# Contains the trip id along with the station ids and the times it stops at them
-with open('data/stop_times.pkl', 'rb') as file:
-    trip_stop_data = pickle.load(file)
+# Side of a cell of the grid over the stops in metres, around the distance between stations
+STOP_GRID_CELL = 2000
 
-with open('data/stop_times_rand.pkl', 'rb') as file:
-    trip_stop_dict_data = pickle.load(file)
 
-router = APIRouter()
+@dataclass(frozen=True)
+class Prebuilt:
+    '''
+    A response serialized once, along with its gzipped copy and an ETag from its content.
+    '''
+    body: bytes
+    gzip: bytes
+    etag: str
+
+
+def prebuild(kind: str, body: bytes) -> Prebuilt:
+    return Prebuilt(body, gzip.compress(body), make_etag(kind, hashlib.sha256(body).hexdigest()[:16]))
+
+
+@data.dataset('stop_responses')
+def load_stop_responses(requires):
+    # The stops only change with the static data, so both formats are built with it rather than per request
+    stops = requires('stop_data').values()
+    stop_list = Stops(stop_list=[{'name': stop['stop_name'], 'coords': [stop['stop_lon'], stop['stop_lat']],
+                                  'station_id': stop['stop_id']} for stop in stops])
+    geojson = {'type': 'FeatureCollection',
+               'features': [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [stop['stop_lon'], stop['stop_lat']]},
+                             'properties': {'name': stop['stop_name'], 'station_id': stop['stop_id']}} for stop in stops]}
+    return {StopsFormat.JSON: prebuild('stops', stop_list.json().encode()),
+            StopsFormat.GEOJSON: prebuild('stops-geojson', json.dumps(geojson).encode())}
+
+
+@data.dataset('stop_grid')
+def load_stop_grid(requires):
+    stops = list(requires('stop_data').values())
+    xy = to_xy([stop['stop_lon'] for stop in stops], [stop['stop_lat'] for stop in stops]).reshape(-1, 2)
+    return Grid(xy, STOP_GRID_CELL, [stop['stop_id'] for stop in stops])
+
+
+if not data.LAZY:
+    data.get('stop_responses')
+    data.get('stop_grid')
+
 
 @router.get('/', tags=['Station'], response_model=Stops)
-async def get_stops() -> Stops:
+async def get_stops(request: Request, format: StopsFormat = StopsFormat.JSON) -> Response:
     '''
-    Return a list of all stops.
+    Return a list of all stops, or with format=geojson a FeatureCollection of them.
 
     '''
-    return {'stop_list': [{'name': stop_inf['stop_name'], 'coords': [stop_inf['stop_lon'], stop_inf['stop_lat']], 'station_id': stop_inf['stop_id']}
-                          for stop_id, stop_inf in stop_data.items()]}
+    prebuilt = data.stop_responses[format]
+    return conditional_response(request, prebuilt.body, prebuilt.etag, gzip_body=prebuilt.gzip,
+                                media_type='application/geo+json' if format == StopsFormat.GEOJSON else 'application/json')
+
+
+@router.get('/nearby', tags=['Station'], response_model=NearbyStops)
+async def get_nearby_stops(lat: float = Query(..., ge=-90, le=90), lon: float = Query(..., ge=-180, le=180),
+                           k: int = Query(5, ge=1, le=100),
+                           radius: float | None = Query(None, gt=0, description='Only stops within this many metres')) -> NearbyStops:
+    '''
+    Return the k stops nearest to a position, closest first.
+
+    '''
+    static = data.current()
+    grid = static.stop_grid
+    indices, distances = grid.nearest(to_xy(lon, lat), k, radius or np.inf)
+    stops = [static.stop_data[grid.keys[i]] for i in indices]
+    return {'stop_list': [{'name': stop['stop_name'], 'coords': [stop['stop_lon'], stop['stop_lat']],
+                           'station_id': stop['stop_id'], 'distance': distance}
+                          for stop, distance in zip(stops, distances.tolist())]}
+
 
 @router.get('/stop_times/{trip_id}', tags=['Stop'], response_model=TripInfo)
 async def get_trip_info_data(trip_id: str) -> TripInfo:
-    return {'trip_id': trip_id, 'Trips': trip_stop_data[trip_id]}
+    return {'trip_id': trip_id, 'Trips': data.stop_times.records(trip_id)}
 
 
 @router.get('/stop_times_dict/{trip_id}', tags=['Stop'], response_model=TripInfoDict)
 async def get_trip_info_dict_data(trip_id: str) -> TripInfoDict:
-    return {'trip_id': trip_id, 'Trips': trip_stop_dict_data[trip_id]}
\ No newline at end of file
+    return {'trip_id': trip_id, 'Trips': data.stop_times.sequence_records(trip_id)}
@@ -0,0 +1,98 @@
+'''
+Compact, columnar store of the stop times of every trip.
+
+Built by get_gtfs.py into the static bundle (see src.bundle). Rather than a dict of
+lists of dicts, the stop times are laid out CSR style: the stops of the i-th trip are
+rows offsets[i]:offsets[i + 1] of the stop, arrival and sequence arrays.
+
+'''
+import numpy as np
+
+from src.bundle import find
+
+
+def seconds_to_time(seconds: int) -> str:
+    '''
+    Formats seconds since the start of the service day as a GTFS HH:MM:SS time,
+    which carries over 24:00:00 for services running past midnight.
+    '''
+    return f'{seconds // 3600:02}:{seconds % 3600 // 60:02}:{seconds % 60:02}'
+
+
+class StopTimes:
+    '''
+    trip_ids: sorted trip ids
+    offsets: where the rows of each trip start, with the total number of rows at the end
+    stops: index of each row's stop into stop_ids
+    arrivals: seconds since the start of the service day (int32)
+    sequences: GTFS stop_sequence of each row (int32)
+    stop_ids: the distinct stop ids
+    '''
+
+    def __init__(self, arrays):
+        self.trip_ids = arrays['trip_ids']
+        self.offsets = arrays['offsets']
+        self.stops = arrays['stops']
+        self.arrivals = arrays['arrivals']
+        self.sequences = arrays['sequences']
+        # Only a few hundred of these, so keep them as interned python strings
+        self.stop_ids = [str(stop_id) for stop_id in arrays['stop_ids']]
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(self.stop_ids)}
+
+    def __contains__(self, trip_id: str) -> bool:
+        return find(self.trip_ids, trip_id) is not None
+
+    def __len__(self) -> int:
+        return len(self.trip_ids)
+
+    def rows(self, trip_id: str) -> slice:
+        i = find(self.trip_ids, trip_id)
+        if i is None:
+            raise KeyError(trip_id)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def trip_arrivals(self, trip_id: str) -> np.ndarray:
+        return self.arrivals[self.rows(trip_id)]
+
+    def trip_stops(self, trip_id: str) -> np.ndarray:
+        return self.stops[self.rows(trip_id)]
+
+    def trip_stop_ids(self, trip_id: str) -> list[str]:
+        return [self.stop_ids[stop] for stop in self.trip_stops(trip_id)]
+
+    def records(self, trip_id: str) -> list[dict]:
+        '''
+        The stop times of a trip in the shape of TripStop.
+        '''
+        rows = self.rows(trip_id)
+        return [{'arrival_time': seconds_to_time(int(arrival)), 'stop_id': self.stop_ids[stop]}
+                for arrival, stop in zip(self.arrivals[rows], self.stops[rows])]
+
+    def sequence_records(self, trip_id: str) -> dict[int, dict]:
+        '''
+        The stop times of a trip in the shape of TripStopDict, indexed by stop_sequence.
+        '''
+        rows = self.rows(trip_id)
+        return {int(sequence): {'arrival_time': seconds_to_time(int(arrival)), 'stop_id': self.stop_ids[stop],
+                                'stop_sequence': int(sequence)}
+                for arrival, stop, sequence in zip(self.arrivals[rows], self.stops[rows], self.sequences[rows])}
+
+
+class Trips:
+    '''
+    Route and shape of each trip, from trips.txt.
+    '''
+
+    def __init__(self, arrays):
+        self.trip_ids = arrays['trip_ids']
+        self.route_ids = arrays['route_ids']
+        self.shape_ids = arrays['shape_ids']
+
+    def __contains__(self, trip_id: str) -> bool:
+        return find(self.trip_ids, trip_id) is not None
+
+    def __getitem__(self, trip_id: str) -> dict:
+        i = find(self.trip_ids, trip_id)
+        if i is None:
+            raise KeyError(trip_id)
+        return {'route_id': str(self.route_ids[i]), 'shape_id': str(self.shape_ids[i])}
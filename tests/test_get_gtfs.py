@@ -0,0 +1,173 @@
+'''
+Downloading and extracting the static GTFS feed, against a local file server stand-in.
+
+'''
+import asyncio
+import io
+import json
+import os
+import threading
+from zipfile import ZipFile
+
+import pytest
+from aiohttp import web
+
+import get_gtfs
+
+
+class FileServer:
+    '''
+    Serves a directory with aiohttp, which handles ETag, If-None-Match, If-Modified-Since, Range and If-Range,
+    recording the status of each response.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.statuses = []
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self):
+        # File responses only settle on 304 or 206 as they are sent, so the status is taken then
+        async def record(request, response):
+            self.statuses.append(response.status)
+
+        app = web.Application()
+        app.on_response_prepare.append(record)
+        app.router.add_static('/', self.root)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def gtfs_zip(contents: dict[str, bytes]) -> bytes:
+    inner = io.BytesIO()
+    with ZipFile(inner, 'w') as archive:
+        for name, data in contents.items():
+            archive.writestr(name, data)
+
+    outer = io.BytesIO()
+    with ZipFile(outer, 'w') as archive:
+        archive.writestr('1/google_transit.zip', b'not metro')
+        archive.writestr(get_gtfs.METRO_ZIP, inner.getvalue())
+    return outer.getvalue()
+
+
+def publish(path, content: bytes, mtime: int) -> None:
+    path.write_bytes(content)
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    served = tmp_path / 'served'
+    served.mkdir()
+    work = tmp_path / 'work'
+    work.mkdir()
+    monkeypatch.chdir(work)
+
+    server = FileServer(served)
+    monkeypatch.setattr(get_gtfs, 'GTFS_URL', f'http://127.0.0.1:{server.port}/gtfs.zip')
+    yield server
+    server.close()
+
+
+FEED = gtfs_zip({name: f'{name} contents\n'.encode() * 50000 for name in get_gtfs.GTFS_FILES})
+
+
+def test_download_then_skip_when_unchanged(server):
+    publish(server.root / 'gtfs.zip', FEED, 1_700_000_000)
+
+    assert get_gtfs.download()
+    with open(get_gtfs.GTFS_ZIP, 'rb') as file:
+        assert file.read() == FEED
+    with open(get_gtfs.GTFS_META) as file:
+        assert json.load(file)['etag']
+    assert not os.path.exists(get_gtfs.GTFS_PART)
+
+    # Sent If-None-Match / If-Modified-Since and got a 304, leaving the copy as is
+    assert not get_gtfs.download()
+    assert server.statuses == [200, 304]
+
+
+def test_download_again_when_the_feed_changes(server):
+    publish(server.root / 'gtfs.zip', FEED, 1_700_000_000)
+    assert get_gtfs.download()
+
+    changed = gtfs_zip({name: b'new\n' for name in get_gtfs.GTFS_FILES})
+    publish(server.root / 'gtfs.zip', changed, 1_700_100_000)
+    assert get_gtfs.download()
+    with open(get_gtfs.GTFS_ZIP, 'rb') as file:
+        assert file.read() == changed
+    assert server.statuses == [200, 200]
+
+
+def test_interrupted_download_is_resumed(server):
+    publish(server.root / 'gtfs.zip', FEED, 1_700_000_000)
+    assert get_gtfs.download()
+    with open(get_gtfs.GTFS_META) as file:
+        meta = json.load(file)
+
+    # As if the download had stopped part way through
+    os.remove(get_gtfs.GTFS_ZIP)
+    with open(get_gtfs.GTFS_PART, 'wb') as file:
+        file.write(FEED[:len(FEED) // 3])
+    with open(get_gtfs.GTFS_PART_META, 'w') as file:
+        json.dump(meta, file)
+
+    assert get_gtfs.download()
+    with open(get_gtfs.GTFS_ZIP, 'rb') as file:
+        assert file.read() == FEED
+    assert server.statuses == [200, 206]
+
+
+def test_resume_starts_over_if_the_feed_changed_meanwhile(server):
+    publish(server.root / 'gtfs.zip', FEED, 1_700_000_000)
+    # Part of an older feed, aiohttp only compares If-Range as a date so that's what it was saved with
+    with open(get_gtfs.GTFS_PART, 'wb') as file:
+        file.write(b'x' * 1000)
+    with open(get_gtfs.GTFS_PART_META, 'w') as file:
+        json.dump({'url': get_gtfs.GTFS_URL, 'etag': None, 'last_modified': 'Tue, 14 Nov 2023 00:00:00 GMT'}, file)
+
+    # If-Range doesn't match, so the whole file comes back rather than the rest of the stale one
+    assert get_gtfs.download()
+    with open(get_gtfs.GTFS_ZIP, 'rb') as file:
+        assert file.read() == FEED
+    assert server.statuses == [200]
+
+
+
+def test_whole_part_file_is_fetched_again(server):
+    publish(server.root / 'gtfs.zip', FEED, 1_700_000_000)
+    assert get_gtfs.download()
+
+    # As if it had stopped after the last chunk, before the part was moved into place
+    os.replace(get_gtfs.GTFS_ZIP, get_gtfs.GTFS_PART)
+    os.replace(get_gtfs.GTFS_META, get_gtfs.GTFS_PART_META)
+
+    # The range past the end is refused, so the part is dropped and the whole file fetched instead
+    assert get_gtfs.download()
+    with open(get_gtfs.GTFS_ZIP, 'rb') as file:
+        assert file.read() == FEED
+    assert not os.path.exists(get_gtfs.GTFS_PART) and not os.path.exists(get_gtfs.GTFS_PART_META)
+    assert server.statuses == [200, 416, 200]
+
+    assert not get_gtfs.download()
+
+def test_extract_reads_the_metro_zip_from_the_outer_archive(server):
+    with open(get_gtfs.GTFS_ZIP, 'wb') as file:
+        file.write(FEED)
+    os.mkdir('data')
+
+    get_gtfs.extract()
+    for name in get_gtfs.GTFS_FILES:
+        with open(os.path.join('data', name), 'rb') as file:
+            assert file.read() == f'{name} contents\n'.encode() * 50000
+    assert not os.path.exists('2')
@@ -0,0 +1,106 @@
+'''
+Fetching the realtime feeds, against a local stand-in for the vicroads API.
+
+'''
+import asyncio
+import os
+import time
+
+# Nothing here needs the static data, so don't load it on import
+os.environ.setdefault('LAZY_DATA', '1')
+os.environ.setdefault('PrimaryKey', 'test')
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from src import feed
+from src import realtime
+from src.gtfs_pb2 import FeedMessage
+
+
+def feed_message(timestamp: int) -> bytes:
+    message = FeedMessage()
+    message.header.gtfs_realtime_version = '2.0'
+    message.header.timestamp = timestamp
+    return message.SerializeToString()
+
+
+async def stand_in(handlers: dict) -> TestServer:
+    app = web.Application()
+    for path, handler in handlers.items():
+        app.router.add_get(path, handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def respond(body: bytes = b'', delay: float = 0, status: int = 200):
+    async def handler(request):
+        await asyncio.sleep(delay)
+        return web.Response(body=body, status=status)
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(feed, 'state', feed.state)
+    monkeypatch.setattr(realtime, 'fetch_stats', {})
+    monkeypatch.setattr(realtime, 'session', None)
+
+
+def run(server_handlers: dict, test):
+    async def main():
+        server = await stand_in(server_handlers)
+        try:
+            return await test(server)
+        finally:
+            await realtime.close_session()
+            await server.close()
+    return asyncio.run(main())
+
+
+def test_feeds_are_fetched_concurrently():
+    async def test(server):
+        start = time.perf_counter()
+        locations, updates = await asyncio.gather(realtime.fetch_feed('vehicle_position', str(server.make_url('/r'))),
+                                                  realtime.fetch_feed('trip_update', str(server.make_url('/t'))))
+        return time.perf_counter() - start, locations, updates
+
+    elapsed, locations, updates = run({'/r': respond(b'r' * 10, delay=0.3), '/t': respond(b't' * 20, delay=0.3)}, test)
+    assert elapsed < 0.5
+    assert (locations, updates) == (b'r' * 10, b't' * 20)
+    assert realtime.fetch_stats['vehicle_position'].ok and realtime.fetch_stats['vehicle_position'].size == 10
+    assert realtime.fetch_stats['trip_update'].ok and realtime.fetch_stats['trip_update'].size == 20
+
+
+def test_slow_feed_times_out_without_holding_up_the_other(monkeypatch):
+    monkeypatch.setattr(realtime, 'FEED_TIMEOUT', aiohttp.ClientTimeout(total=0.2))
+
+    async def test(server):
+        return await asyncio.gather(realtime.fetch_feed('vehicle_position', str(server.make_url('/r'))),
+                                    realtime.fetch_feed('trip_update', str(server.make_url('/t'))),
+                                    return_exceptions=True)
+
+    locations, updates = run({'/r': respond(b'r'), '/t': respond(b't', delay=2)}, test)
+    assert locations == b'r'
+    assert isinstance(updates, asyncio.TimeoutError)
+    assert realtime.fetch_stats['vehicle_position'].ok
+    assert not realtime.fetch_stats['trip_update'].ok
+    assert realtime.fetch_stats['trip_update'].latency < 1
+
+
+def test_failing_feed_keeps_its_previous_version(monkeypatch):
+    async def test(server):
+        monkeypatch.setattr(realtime, 'GTFS_R', str(server.make_url('/r')))
+        monkeypatch.setattr(realtime, 'GTFS_T', str(server.make_url('/t')))
+        await realtime.update_realtime.__wrapped__()
+
+    previous = feed.state
+    run({'/r': respond(feed_message(1000)), '/t': respond(status=500)}, test)
+
+    assert feed.state.snapshot.timestamp == 1000
+    assert feed.state.trip_update_snapshot is previous.trip_update_snapshot
+    assert feed.state.update_data is previous.update_data
+    assert not realtime.fetch_stats['trip_update'].ok